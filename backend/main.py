@@ -3,19 +3,94 @@ FastAPI application — Photo Mosaic Generator backend.
 """
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import io
+import logging
+import os
+import shutil
+import tempfile
 import time
+from contextlib import asynccontextmanager
 from typing import List, Optional
 
-from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi import FastAPI, File, Form, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, Response
+from fastapi.responses import ORJSONResponse, Response
 
-from mosaic import analyze_sources, generate_mosaic, generate_preview
+import numpy as np
+import PIL
+from PIL import features
 
-app = FastAPI(title="Photo Mosaic API", version="2.0.0")
+from mosaic import (
+    OUTPUT_FORMATS,
+    TileCache,
+    analyze_sources,
+    generate_mosaic,
+    generate_preview,
+    palette_entries,
+    palette_lab_arrays,
+    resolve_output_format,
+    warm_up,
+)
+
+
+logger = logging.getLogger("uvicorn.error")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pillow-SIMD builds report a ".postN" version; lets deployers confirm which is loaded
+    logger.info(
+        "Pillow %s (libjpeg-turbo: %s, libimagequant: %s)",
+        PIL.__version__,
+        features.check_feature("libjpeg_turbo"),
+        features.check_feature("libimagequant"),
+    )
+    # JIT-compile the optional Numba kernels now rather than on the first generate
+    layer = warm_up()
+    if layer == "workqueue":
+        logger.warning(
+            "Numba is using the workqueue threading layer: kernel calls are serialized "
+            "across requests. Install OpenMP or TBB (pip install tbb) for concurrent kernels."
+        )
+    yield
+    for sid in list(_SESSIONS):
+        _drop_session(sid)
+
+
+app = FastAPI(
+    title="Photo Mosaic API",
+    version="2.0.0",
+    lifespan=lifespan,
+    # orjson: faster than json.dumps, compact output, serializes numpy natively
+    default_response_class=ORJSONResponse,
+)
 
-# Allow the Next.js dev server to call us
+# Assemble mosaics on a CUDA GPU when CuPy is installed (MOSAIC_GPU=1)
+USE_GPU = os.environ.get("MOSAIC_GPU") == "1"
+# Image library for source decode/resize and encoding: "pil" (default) or "vips"
+IMAGE_BACKEND = os.environ.get("MOSAIC_IMAGE_BACKEND", "pil")
+
+# ---------------------------------------------------------------------------
+# Upload limits
+# ---------------------------------------------------------------------------
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024    # per file
+MAX_REQUEST_BYTES = 200 * 1024 * 1024  # per multipart request
+_READ_CHUNK_BYTES = 1024 * 1024
+
+
+@app.middleware("http")
+async def _limit_request_size(request: Request, call_next):
+    """Reject oversize uploads from Content-Length before the body is parsed."""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        return ORJSONResponse({"detail": "Request body too large."}, status_code=413)
+    return await call_next(request)
+
+
+# Allow the Next.js dev server to call us (added last so it wraps the size limit too)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
@@ -24,8 +99,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+async def _read_upload(f: UploadFile) -> bytes:
+    """
+    Read an upload in 1 MiB chunks, yielding to the event loop between chunks
+    so concurrent requests interleave, and enforce MAX_UPLOAD_BYTES.
+    """
+    buf = bytearray()
+    while chunk := await f.read(_READ_CHUNK_BYTES):
+        buf += chunk
+        if len(buf) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File {f.filename!r} is too large.")
+    return bytes(buf)
+
+
 # ---------------------------------------------------------------------------
 # In-memory session storage (suitable for a single-user local tool)
+# Source uploads are spooled to a per-session temp dir rather than held in RAM.
 # Sessions are evicted after SESSION_TTL_SECONDS of inactivity.
 # ---------------------------------------------------------------------------
 _SESSIONS: dict[str, dict] = {}
@@ -38,6 +128,37 @@ def _touch_session(session_id: str) -> None:
         _SESSIONS[session_id]["last_accessed"] = time.monotonic()
 
 
+def _drop_session(session_id: str) -> None:
+    """Forget a session and delete its spooled source files."""
+    data = _SESSIONS.pop(session_id, None)
+    if data is not None:
+        shutil.rmtree(data["dir"], ignore_errors=True)
+
+
+# Resized tiles shared by all sessions, keyed by (source content hash, tile_size)
+TILE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+_TILE_CACHE = TileCache(max_bytes=TILE_CACHE_MAX_BYTES)
+
+
+def _spool_sources(paths: List[str], raw_bytes: List[bytes]) -> List[bytes]:
+    """Write uploaded source images to their session paths; return their content hashes."""
+    keys = []
+    for path, data in zip(paths, raw_bytes):
+        with open(path, "wb") as fh:
+            fh.write(data)
+        keys.append(hashlib.blake2b(data, digest_size=16).digest())
+    return keys
+
+
+def _session_palette_arrays(session: dict, n: int) -> dict:
+    """
+    Matching arrays for the first n palette entries (the caller's snapshot).
+    Cells are matched exactly; the approximate build_lab_lut table is not used
+    here, as exact matching over distinct cell colors is as fast.
+    """
+    return {"palette_lab": session["palette_lab"][:n], "palette_sq": session["palette_sq"][:n]}
+
+
 def _evict_stale_sessions() -> None:
     """Remove sessions that have not been accessed within SESSION_TTL_SECONDS."""
     now = time.monotonic()
@@ -46,7 +167,7 @@ def _evict_stale_sessions() -> None:
         if now - data.get("last_accessed", 0) > SESSION_TTL_SECONDS
     ]
     for sid in stale:
-        del _SESSIONS[sid]
+        _drop_session(sid)
 
 
 @app.get("/api/health")
@@ -67,35 +188,49 @@ async def analyze(
     """
     _evict_stale_sessions()
 
-    raw_bytes: List[bytes] = []
-    for f in files:
-        data = await f.read()
-        raw_bytes.append(data)
+    raw_bytes: List[bytes] = list(await asyncio.gather(*(_read_upload(f) for f in files)))
 
-    palette = analyze_sources(raw_bytes)
+    # Decoding is CPU-bound; keep it off the event loop so other requests are served
+    palette = await run_in_threadpool(analyze_sources, raw_bytes, IMAGE_BACKEND)
+    palette_lab, palette_sq = palette_lab_arrays(palette)
 
-    if session_id in _SESSIONS:
-        # Append to existing session — chunked upload support
-        existing = _SESSIONS[session_id]
-        offset = len(existing["source_bytes"])
-        # Re-index palette entries to continue from the existing offset
-        for entry in palette:
-            entry["index"] += offset
-        existing["source_bytes"].extend(raw_bytes)
-        existing["palette"].extend(palette)
-        merged_palette = existing["palette"]
-    else:
+    session = _SESSIONS.get(session_id)
+    if session is None:
         # New session
-        _SESSIONS[session_id] = {
-            "source_bytes": raw_bytes,
-            "palette": palette,
-            "tile_cache": {},  # {(idx, tile_size): PIL.Image} — persists across generate calls
+        session = _SESSIONS[session_id] = {
+            "dir": tempfile.mkdtemp(prefix="mosaic-"),
+            "source_paths": [],  # one spooled file per uploaded source, by palette "index"
+            "source_keys": [],   # content hash per source — the shared tile cache key
+            "palette": {  # Palette arrays, replaced (never mutated) as batches arrive
+                "indices": np.empty((0,), dtype=np.int64),
+                "rgb": np.empty((0, 3), dtype=np.float32),
+            },
+            "palette_lab": np.empty((0, 3), dtype=np.float32),  # (P, 3) LAB, computed once per upload batch
+            "palette_sq": np.empty((0,), dtype=np.float32),     # (P,) squared LAB norms for the GEMM distance
             "last_accessed": time.monotonic(),
         }
-        merged_palette = palette
+
+    # Append to the session — chunked upload support. Reserve file slots before
+    # awaiting so concurrent batches for the same session get disjoint indices.
+    offset = len(session["source_paths"])
+    paths = [os.path.join(session["dir"], f"{offset + i:06d}") for i in range(len(raw_bytes))]
+    session["source_paths"].extend(paths)
+    session["source_keys"].extend([None] * len(paths))
+    keys = await run_in_threadpool(_spool_sources, paths, raw_bytes)
+    session["source_keys"][offset:offset + len(keys)] = keys
+
+    # Re-index palette entries to continue from the existing offset
+    merged_palette = {
+        "indices": np.concatenate([session["palette"]["indices"], palette["indices"] + offset]),
+        "rgb": np.concatenate([session["palette"]["rgb"], palette["rgb"]]),
+    }
+    session["palette"] = merged_palette
+    session["palette_lab"] = np.concatenate([session["palette_lab"], palette_lab])
+    session["palette_sq"] = np.concatenate([session["palette_sq"], palette_sq])
 
     _touch_session(session_id)
-    return JSONResponse({"palette": merged_palette, "count": len(merged_palette)})
+    entries = palette_entries(merged_palette)
+    return ORJSONResponse({"palette": entries, "count": len(entries)})
 
 
 @app.post("/api/preview")
@@ -110,14 +245,24 @@ async def preview(
     if session_id not in _SESSIONS:
         raise HTTPException(status_code=404, detail="Session not found. Upload sources first.")
 
-    palette = _SESSIONS[session_id]["palette"]
-    if not palette:
+    session = _SESSIONS[session_id]
+    # Snapshot: a concurrent chunked /api/analyze may extend the session while we run
+    palette = session["palette"]
+    n_entries = len(palette["indices"])
+    if not n_entries:
         raise HTTPException(status_code=400, detail="No palette data.")
 
     _touch_session(session_id)
-    main_bytes = await main_image.read()
-    result = generate_preview(main_bytes, palette, tile_size=tile_size)
-    return JSONResponse(result)
+    main_bytes = await _read_upload(main_image)
+    palette_arrays = _session_palette_arrays(session, n_entries)
+    result = await run_in_threadpool(
+        generate_preview,
+        main_bytes,
+        palette,
+        tile_size=tile_size,
+        **palette_arrays,
+    )
+    return ORJSONResponse(result)
 
 
 @app.post("/api/generate")
@@ -130,32 +275,45 @@ async def generate(
     overlay_opacity: float = Form(0.25, ge=0.0, le=1.0),
     shuffle_sources: bool = Form(False),
     a4_output: bool = Form(False),
+    output_format: Optional[str] = Form(None),
+    compress_level: int = Form(1, ge=0, le=9),
 ):
     """
-    Generate the full-resolution mosaic PNG.
-    Returns the image as a binary PNG response.
+    Generate the full-resolution mosaic.
+    Returns the image as a binary PNG, lossless WebP or JPEG response
+    (default: JPEG for A4 output, PNG otherwise).
     """
     if session_id not in _SESSIONS:
         raise HTTPException(status_code=404, detail="Session not found. Upload sources first.")
 
     session = _SESSIONS[session_id]
+    # Snapshot: a concurrent chunked /api/analyze may extend the session while we run
     palette = session["palette"]
-    source_bytes = session["source_bytes"]
-    tile_cache = session.get("tile_cache", {})
+    n_entries = len(palette["indices"])
+    source_paths = session["source_paths"]
+    source_keys = session["source_keys"]
 
-    if not palette:
+    if not n_entries:
         raise HTTPException(status_code=400, detail="No source images / palette. Upload sources first.")
 
     if style not in ("A", "B", "C"):
         raise HTTPException(status_code=422, detail="style must be A, B, or C")
 
+    try:
+        output_format = resolve_output_format(output_format, a4_output)
+    except ValueError:
+        raise HTTPException(status_code=422, detail="output_format must be PNG, WEBP or JPEG")
+
     _touch_session(session_id)
-    main_bytes = await main_image.read()
+    main_bytes = await _read_upload(main_image)
+    palette_arrays = _session_palette_arrays(session, n_entries)
 
     try:
-        mosaic_png = generate_mosaic(
+        # numpy / Pillow release the GIL, so a worker thread keeps the event loop responsive
+        mosaic_bytes = await run_in_threadpool(
+            generate_mosaic,
             main_image_bytes=main_bytes,
-            source_images_bytes=source_bytes,
+            source_images=source_paths,
             palette=palette,
             tile_size=tile_size,
             style=style,
@@ -163,13 +321,20 @@ async def generate(
             overlay_opacity=overlay_opacity,
             shuffle_sources=shuffle_sources,
             a4_output=a4_output,
-            tile_cache=tile_cache,
+            tile_cache=_TILE_CACHE,
+            source_keys=source_keys,
+            **palette_arrays,
+            output_format=output_format,
+            compress_level=compress_level,
+            gpu=USE_GPU,
+            backend=IMAGE_BACKEND,
         )
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
+    media_type, ext = OUTPUT_FORMATS[output_format]
     return Response(
-        content=mosaic_png,
-        media_type="image/png",
-        headers={"Content-Disposition": 'attachment; filename="mosaic.png"'},
+        content=mosaic_bytes,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="mosaic.{ext}"'},
     )
@@ -1,27 +1,75 @@
 """
 Core mosaic generation algorithm.
-Uses pure numpy for all color matching — no scipy dependency.
+Color matching runs on numpy; scipy (kd-tree, optimal unique-tile assignment) and
+numba (parallel matching and canvas assembly kernels) are optional accelerators.
 
 Performance improvements over v1:
-- Vectorized cell-average computation via reshape (no per-cell crop loop)
-- Vectorized nearest-neighbor matching over all cells in one broadcast
+- Cell averages via a single BOX resize to (cols, rows) (no per-cell crop loop)
+- Nearest-neighbor matching once per distinct cell color: a kd-tree for large
+  palettes when scipy is installed, else a parallel Numba scan, else one BLAS matmul
 - CIE LAB color space for perceptually uniform distance matching
-- Session-level tile resize cache keyed by (idx, tile_size)
-- Compressed PNG output (optimize=True, compress_level=6)
+- Table-driven sRGB→XYZ for cell colors (rgb_to_lab_u8)
+- Byte-bounded LRU tile cache keyed by (content hash, tile_size), shared across sessions
+- Canvas assembled as one numpy array (no per-cell PIL paste), parallel via Numba if installed
+- Palette converted to LAB once per session (palette_lab_arrays)
+- Optional approximate LAB grid → palette lookup table (build_lab_lut), opt-in
+- BOX tile downscale, BILINEAR for the backdrop resizes (LANCZOS only for big upscales)
+- Fast PNG output (compress_level=1, no optimize pass), lossless WebP, or JPEG (A4 default)
 """
 from __future__ import annotations
 
+import base64
+import contextlib
 import io
+import logging
 import math
-import random
-from typing import List, Tuple
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Hashable, List, Literal, Sequence, Tuple
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps, ImageStat
+
+logger = logging.getLogger(__name__)
+
+try:  # optional: parallel JIT kernels for canvas assembly
+    import numba
+    from numba import njit, prange
+    # Kernels run on FastAPI worker threads; the TBB layer can hang interpreter
+    # exit when first used off the main thread, so prefer OpenMP when present.
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+    _HAVE_NUMBA = True
+except ImportError:  # pragma: no cover - numpy fallback is used instead
+    _HAVE_NUMBA = False
+
+try:  # optional: libvips backend for source decode/resize and output encoding
+    import pyvips
+    _HAVE_VIPS = True
+except (ImportError, OSError):  # pragma: no cover - OSError when libvips itself is missing
+    _HAVE_VIPS = False
+
+# "pil" (default) or "vips" — selects the library used for source tiles and encoding
+ImageBackend = Literal["pil", "vips"]
+
+try:  # optional: CUDA canvas assembly (generate_mosaic(gpu=True))
+    import cupy as cp
+    _HAVE_CUPY = True
+except ImportError:  # pragma: no cover - CPU assembly is used instead
+    _HAVE_CUPY = False
+
+try:  # optional: optimal unique-tile assignment and kd-tree nearest-neighbor search
+    from scipy.optimize import linear_sum_assignment
+    from scipy.spatial import cKDTree
+    _HAVE_SCIPY = True
+except ImportError:  # pragma: no cover - greedy matching is used instead
+    _HAVE_SCIPY = False
 
 
 # ---------------------------------------------------------------------------
-# CIE LAB color conversion (pure numpy, no scipy)
+# CIE LAB color conversion (pure numpy)
 # ---------------------------------------------------------------------------
 
 def _srgb_to_linear(c: np.ndarray) -> np.ndarray:
@@ -30,14 +78,17 @@ def _srgb_to_linear(c: np.ndarray) -> np.ndarray:
     return np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
 
 
+# Linear RGB → CIE XYZ (D65 illuminant)
+_RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+], dtype=np.float32)
+
+
 def _linear_to_xyz(rgb_linear: np.ndarray) -> np.ndarray:
     """Linear RGB → CIE XYZ (D65 illuminant). Input shape (..., 3)."""
-    M = np.array([
-        [0.4124564, 0.3575761, 0.1804375],
-        [0.2126729, 0.7151522, 0.0721750],
-        [0.0193339, 0.1191920, 0.9503041],
-    ], dtype=np.float32)
-    return rgb_linear @ M.T
+    return rgb_linear @ _RGB_TO_XYZ.T
 
 
 def _xyz_to_lab(xyz: np.ndarray) -> np.ndarray:
@@ -71,103 +122,718 @@ def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
     return _xyz_to_lab(xyz).astype(np.float32)
 
 
+# Per-channel sRGB uint8 → XYZ contribution tables, shape (3, 256, 3).
+# The sRGB curve and the XYZ matrix are both per-channel linear after the
+# gamma step, so XYZ = _XYZ_LUT[0][r] + _XYZ_LUT[1][g] + _XYZ_LUT[2][b].
+_SRGB_LIN_LUT = _srgb_to_linear(np.arange(256, dtype=np.float32)).astype(np.float32)
+_XYZ_LUT = (_SRGB_LIN_LUT[None, :, None] * _RGB_TO_XYZ.T[:, None, :]).astype(np.float32)
+
+
+def rgb_to_lab_u8(rgb: np.ndarray) -> np.ndarray:
+    """
+    Convert a uint8 RGB array (shape (..., 3)) to CIE LAB via table lookups.
+    Replaces the sRGB gamma and XYZ matmul with three gathers and two adds.
+    """
+    xyz = _XYZ_LUT[0][rgb[..., 0]] + _XYZ_LUT[1][rgb[..., 1]] + _XYZ_LUT[2][rgb[..., 2]]
+    return _xyz_to_lab(xyz).astype(np.float32)
+
+
+def _cells_to_lab(cell_colors_rgb: np.ndarray) -> np.ndarray:
+    """Round float cell means (0-255) to uint8 and convert with rgb_to_lab_u8."""
+    return rgb_to_lab_u8(np.clip(np.rint(cell_colors_rgb), 0, 255).astype(np.uint8))
+
+
 # ---------------------------------------------------------------------------
 # Helper utilities
 # ---------------------------------------------------------------------------
 
-def _avg_color_arr(arr: np.ndarray) -> Tuple[float, float, float]:
-    """Return mean (R, G, B) of a (H, W, 3) float32 array."""
-    return float(arr[:, :, 0].mean()), float(arr[:, :, 1].mean()), float(arr[:, :, 2].mean())
+def _avg_color(img: Image.Image) -> Tuple[float, float, float]:
+    """
+    Return the mean (R, G, B) of an image as floats 0-255.
+    Computed by Pillow from per-band histograms in C — no numpy copy of the pixels.
+    """
+    r, g, b = ImageStat.Stat(img.convert("RGB")).mean
+    return float(r), float(g), float(b)
 
 
-def _avg_color(img: Image.Image) -> Tuple[float, float, float]:
-    """Return the mean (R, G, B) of an image as floats 0-255."""
-    arr = np.array(img.convert("RGB"), dtype=np.float32)
-    return _avg_color_arr(arr)
+def _cell_means(img: Image.Image, cols: int, rows: int) -> np.ndarray:
+    """
+    Mean color of each mosaic cell as a (rows, cols, 3) float32 array.
+    Pillow's BOX filter is an exact pixel-area average done in C, so this avoids
+    upscaling to the canvas and reducing a full float32 copy of it.
+    """
+    return np.asarray(img.resize((cols, rows), Image.BOX), dtype=np.float32)
+
+
+def _open_source(src: bytes | str | os.PathLike) -> Image.Image:
+    """Open a source image held in memory (bytes) or spooled to disk (path)."""
+    if isinstance(src, (bytes, bytearray)):
+        return Image.open(io.BytesIO(src))
+    return Image.open(src)
+
+
+def _check_backend(backend: str) -> None:
+    if backend not in ("pil", "vips"):
+        raise ValueError(f"Unknown image backend: {backend!r}")
+    if backend == "vips" and not _HAVE_VIPS:
+        raise ValueError("Image backend 'vips' requires pyvips and libvips")
 
 
-def _tint(tile: Image.Image, target_rgb: Tuple[float, float, float], strength: float = 0.55) -> Image.Image:
+def _vips_to_array(img: "pyvips.Image") -> np.ndarray:
+    """Convert a pyvips image to an (H, W, 3) uint8 sRGB array (alpha dropped, like PIL's convert)."""
+    img = img.colourspace("srgb")
+    if img.bands > 3:
+        img = img[0:3]
+    img = img.cast("uchar")
+    return np.ndarray(buffer=img.write_to_memory(), dtype=np.uint8, shape=(img.height, img.width, 3))
+
+
+def _load_tile(src: bytes | str | os.PathLike, tile_size: int, backend: ImageBackend = "pil") -> np.ndarray:
+    """
+    Decode a source image and resize it to a (tile_size, tile_size, 3) uint8 tile.
+    The vips backend uses thumbnail, which shrinks on load (JPEG DCT scaling)
+    and resizes in one multithreaded C call.
     """
-    Color-correct a tile toward target_rgb using a weighted average blend.
+    if backend == "vips":
+        if isinstance(src, (bytes, bytearray)):
+            thumb = pyvips.Image.thumbnail_buffer(src, tile_size, height=tile_size, size="force")
+        else:
+            thumb = pyvips.Image.thumbnail(os.fspath(src), tile_size, height=tile_size, size="force")
+        return _vips_to_array(thumb)
+    with _open_source(src) as img:
+        if img.format == "JPEG":
+            # Tiles are tiny: let libjpeg DCT-downscale to >= tile_size on decode
+            img.draft("RGB", (tile_size, tile_size))
+        # convert() decodes once, eagerly, and closes the spooled file promptly
+        img = img.convert("RGB")
+    # BOX: exact area average — the cheapest filter, and tiles keep the mean color
+    # analyze_sources measured for them
+    tile = img.resize((tile_size, tile_size), Image.BOX)
+    return np.asarray(tile, dtype=np.uint8)
+
+
+def _tint_weight(strength: float) -> int:
+    """Tint strength (0-1) as an 8.8 fixed-point weight (0-256)."""
+    return int(round(min(max(strength, 0.0), 1.0) * 256))
+
+
+def _tint(tiles: np.ndarray, target_rgb: np.ndarray, strength: float = 0.55) -> np.ndarray:
+    """
+    Color-correct uint8 RGB tiles toward uint8 target_rgb using a weighted average blend.
+    target_rgb broadcasts against tiles, so a whole canvas can be tinted in one call.
     strength=1.0 → solid color; strength=0.0 → original tile.
+    Blends in uint16 8.8 fixed point: the result never exceeds 255, so no clip.
     """
-    arr = np.array(tile.convert("RGB"), dtype=np.float32)
-    target = np.array(target_rgb, dtype=np.float32)
-    blended = arr * (1 - strength) + target * strength
-    return Image.fromarray(np.clip(blended, 0, 255).astype(np.uint8), "RGB")
+    s8 = _tint_weight(strength)
+    blended = tiles.astype(np.uint16) * np.uint16(256 - s8) + target_rgb.astype(np.uint16) * np.uint16(s8)
+    return (blended >> 8).astype(np.uint8)
 
 
 # ---------------------------------------------------------------------------
 # Vectorized nearest-neighbor matching (LAB space)
 # ---------------------------------------------------------------------------
 
+def _lab_rank_dists(
+    palette_lab: np.ndarray,
+    cell_lab: np.ndarray,
+    palette_sq: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Ranking distances between every palette entry and every cell, shape (P, N):
+    ||p||² - 2·p·c, i.e. the squared LAB distance ||p - c||² minus ||c||².
+    The dropped term is constant per cell (column), so per-cell argmin/ordering —
+    and assignments that give every cell exactly one entry — are unchanged.
+    The cross term is a single BLAS matmul instead of a (P, N, 3) broadcast temporary.
+    palette_sq may carry the precomputed ||p||² term (see palette_lab_arrays).
+    """
+    if palette_sq is None:
+        palette_sq = np.einsum("ij,ij->i", palette_lab, palette_lab)
+    dists = palette_lab @ cell_lab.T    # (P, N)
+    dists *= -2.0
+    dists += palette_sq[:, None]
+    return dists
+
+
+# Palettes at least this large are searched with a kd-tree (when scipy is
+# installed); below it the GEMM distance matrix is cheaper than building a tree.
+KDTREE_MIN_PALETTE = 128
+
+
+def _smallest_k(dists: np.ndarray, k: int) -> np.ndarray:
+    """
+    Row positions of the k smallest entries in each column of a (P, N) distance
+    matrix, shape (k, N), nearest first. argpartition is O(P) per column; only
+    the k survivors are sorted.
+    """
+    part = np.argpartition(dists, k - 1, axis=0)[:k]  # (k, N) unordered
+    order = np.argsort(np.take_along_axis(dists, part, axis=0), axis=0)
+    return np.take_along_axis(part, order, axis=0)
+
+
+if _HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _nearest_numba(palette_lab, query_lab, out):
+        # Brute-force min-SSE per query: no (P, N) distance matrix, one query per thread
+        for i in prange(query_lab.shape[0]):
+            q0 = query_lab[i, 0]
+            q1 = query_lab[i, 1]
+            q2 = query_lab[i, 2]
+            best = np.inf
+            arg = 0
+            for j in range(palette_lab.shape[0]):
+                d0 = palette_lab[j, 0] - q0
+                d1 = palette_lab[j, 1] - q1
+                d2 = palette_lab[j, 2] - q2
+                d = d0 * d0 + d1 * d1 + d2 * d2
+                if d < best:
+                    best = d
+                    arg = j
+            out[i] = arg
+
+
+def _nearest_positions(
+    palette_lab: np.ndarray,
+    query_lab: np.ndarray,
+    palette_sq: np.ndarray | None = None,
+    k: int = 1,
+) -> np.ndarray:
+    """
+    Positions of the k nearest palette entries for each (N, 3) LAB query.
+    Returns shape (N,) for k=1, else (N, k) ordered nearest-first within a row.
+    Uses a cKDTree (O(log P) per query) for large palettes, else a parallel Numba
+    scan (k=1) or the GEMM distances.
+    """
+    if _HAVE_SCIPY and palette_lab.shape[0] >= KDTREE_MIN_PALETTE:
+        _, idx = cKDTree(palette_lab).query(query_lab, k=k)
+        return idx.astype(np.int32)
+    if _HAVE_NUMBA and k == 1:
+        out = np.empty(query_lab.shape[0], dtype=np.int32)
+        with _numba_guard():
+            _nearest_numba(
+                np.ascontiguousarray(palette_lab, dtype=np.float32),
+                np.ascontiguousarray(query_lab, dtype=np.float32),
+                out,
+            )
+        return out
+    dists = _lab_rank_dists(palette_lab, query_lab, palette_sq)  # (P, N)
+    if k == 1:
+        return np.argmin(dists, axis=0).astype(np.int32)
+    return _smallest_k(dists, k).T.astype(np.int32)
+
+
+# LAB grid resolution per axis for the palette lookup table (bins³ entries),
+# and how many nearest palette candidates each grid point keeps for re-ranking
+LAB_LUT_BINS = 32
+LAB_LUT_CANDIDATES = 16
+# Grid spans the LAB bounding box of the sRGB gamut (L 0..100, a -87..99, b -108..95):
+# cell and palette colors are sRGB means, so bins outside it would never be hit
+_LAB_LUT_OFFSET = np.array([0.0, 87.0, 108.0], dtype=np.float32)
+_LAB_LUT_RANGE = np.array([100.0, 186.0, 203.0], dtype=np.float32)
+
+
+def build_lab_lut(
+    palette_lab: np.ndarray,
+    palette_sq: np.ndarray | None = None,
+    bins: int = LAB_LUT_BINS,
+    candidates: int = LAB_LUT_CANDIDATES,
+) -> np.ndarray:
+    """
+    Precompute the nearest palette positions for every point of a bins³ LAB grid
+    over the sRGB gamut. Built once per palette, it turns cell matching into a
+    quantize-and-gather plus an exact re-rank of a few candidates, instead of a
+    search over the whole palette.
+    The result is approximate: a cell's true nearest entry can fall outside its
+    grid point's candidates, most often with tightly clustered palettes. Exact
+    matching (kd-tree / Numba / GEMM over distinct colors) is usually as fast, so
+    the API does not use it; it remains an opt-in for callers.
+    Returns int32 array of shape (bins**3, min(candidates, P)).
+    """
+    k = min(candidates, palette_lab.shape[0])
+    axes = [np.linspace(-o, r - o, bins, dtype=np.float32) for o, r in zip(_LAB_LUT_OFFSET, _LAB_LUT_RANGE)]
+    grid = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+    lut = np.empty((grid.shape[0], k), dtype=np.int32)
+    step = 4096  # bound the (P, step) distance block
+    for start in range(0, grid.shape[0], step):
+        lut[start:start + step] = _nearest_positions(
+            palette_lab, grid[start:start + step], palette_sq, k=k,
+        ).reshape(-1, k)
+    return lut
+
+
+def _lab_lut_lookup(lut: np.ndarray, cell_lab: np.ndarray, palette_lab: np.ndarray) -> np.ndarray:
+    """
+    Quantize (N, 3) LAB colors onto the build_lab_lut grid, gather each cell's
+    candidates and return the exactly-nearest one among them.
+    """
+    bins = round(lut.shape[0] ** (1.0 / 3.0))
+    q = np.rint((cell_lab + _LAB_LUT_OFFSET) * ((bins - 1) / _LAB_LUT_RANGE))
+    q = np.clip(q, 0, bins - 1).astype(np.int32)
+    cand = lut[(q[:, 0] * bins + q[:, 1]) * bins + q[:, 2]]           # (N, k)
+    dists = ((palette_lab[cand] - cell_lab[:, None, :]) ** 2).sum(axis=2)  # (N, k)
+    return cand[np.arange(cand.shape[0]), np.argmin(dists, axis=1)].astype(np.int32)
+
+
 def _match_all_cells(
     cell_colors_rgb: np.ndarray,   # (N, 3) float32, values 0-255
-    palette_colors_rgb: np.ndarray, # (P, 3) float32, values 0-255
+    palette_lab: np.ndarray,       # (P, 3) float32, LAB
+    palette_sq: np.ndarray | None = None,  # (P,) float32, ||p||²
+    palette_lut: np.ndarray | None = None,  # (bins³, k) from build_lab_lut()
 ) -> np.ndarray:
     """
     For each of N cells, find the index of the nearest palette entry in LAB space.
+    With palette_lut this is a table lookup instead of an exact (P, N) search.
+    Cells are matched at uint8 precision, so each distinct color is matched once.
     Returns int array of shape (N,).
     """
-    cell_lab = rgb_to_lab(cell_colors_rgb)       # (N, 3)
-    palette_lab = rgb_to_lab(palette_colors_rgb)  # (P, 3)
+    rgb = np.clip(np.rint(cell_colors_rgb), 0, 255).astype(np.uint8)
+    packed = (rgb[:, 0].astype(np.int32) << 16) | (rgb[:, 1].astype(np.int32) << 8) | rgb[:, 2]
+    _, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+    cell_lab = rgb_to_lab_u8(rgb[first])  # (U, 3), U <= N distinct colors
+    if palette_lut is not None:
+        return _lab_lut_lookup(palette_lut, cell_lab, palette_lab)[inverse]
+    return _nearest_positions(palette_lab, cell_lab, palette_sq)[inverse]  # (N,)
 
-    # Broadcast: (P, 1, 3) - (1, N, 3) → (P, N, 3) → sum sq → (P, N)
-    diff = palette_lab[:, None, :] - cell_lab[None, :, :]  # (P, N, 3)
-    dists = (diff ** 2).sum(axis=2)                         # (P, N)
-    return np.argmin(dists, axis=0).astype(np.int32)        # (N,)
+
+# Nearest candidates kept per cell for greedy unique matching
+UNIQUE_CANDIDATES = 32
+
+
+def _match_unique(
+    cell_colors_rgb: np.ndarray,   # (N, 3) float32, values 0-255
+    palette_lab: np.ndarray,       # (P, 3) float32, LAB
+    palette_sq: np.ndarray | None = None,  # (P,) float32, ||p||²
+) -> np.ndarray:
+    """
+    Match cells to palette entries using each entry at most once (allow_repeats=False).
+    When every cell can get its own entry (N <= P) and scipy is installed, solves the
+    linear assignment problem for the globally optimal matching. Otherwise assigns
+    greedily in cell order; once the palette is exhausted, cells reuse their nearest entry.
+    Returns int array of shape (N,).
+    """
+    cell_lab = _cells_to_lab(cell_colors_rgb)  # (N, 3)
+    dists = _lab_rank_dists(palette_lab, cell_lab, palette_sq)  # (P, N)
+    n_cells = cell_lab.shape[0]
+
+    if _HAVE_SCIPY and n_cells <= palette_lab.shape[0]:
+        rows, cols = linear_sum_assignment(dists.T)  # rows == arange(N)
+        return cols.astype(np.int32)
+
+    # For each cell, its k nearest palette positions in distance order; only
+    # cells whose k candidates are all taken need to look further
+    k = min(UNIQUE_CANDIDATES, palette_lab.shape[0])
+    candidates = _smallest_k(dists, k)  # (k, N) — sorted by dist per cell
+
+    available = np.ones(palette_lab.shape[0], dtype=bool)
+    n_available = palette_lab.shape[0]
+    best_positions = np.zeros(n_cells, dtype=np.int32)
+    for cell_idx in range(n_cells):
+        chosen = -1
+        for pos in candidates[:, cell_idx]:
+            if available[pos]:
+                chosen = int(pos)
+                break
+        if chosen < 0 and n_available:
+            # All k candidates taken: nearest of the remaining entries
+            chosen = int(np.argmin(np.where(available, dists[:, cell_idx], np.inf)))
+        if chosen < 0:
+            chosen = int(candidates[0, cell_idx])  # palette exhausted: reuse nearest
+        else:
+            available[chosen] = False
+            n_available -= 1
+        best_positions[cell_idx] = chosen
+    return best_positions
 
 
 # ---------------------------------------------------------------------------
-# Public API
+# Canvas assembly (Numba kernels when available, numpy otherwise)
 # ---------------------------------------------------------------------------
 
-def analyze_sources(raw_images: List[bytes]) -> List[dict]:
+# Numba's workqueue threading layer (the fallback when neither OpenMP nor TBB is
+# available, e.g. a plain pip install on macOS) is not thread-safe: two worker
+# threads launching parallel kernels at once abort the process. Serialize
+# kernel calls under it; OpenMP and TBB run concurrent launches safely.
+_NUMBA_LOCK = threading.Lock()
+_NUMBA_SERIALIZE: bool | None = None  # None until a parallel kernel has picked the layer
+
+
+def _numba_guard():
+    """Context manager to hold around every parallel Numba kernel call."""
+    global _NUMBA_SERIALIZE
+    if _NUMBA_SERIALIZE is None:
+        try:
+            _NUMBA_SERIALIZE = numba.threading_layer() == "workqueue"
+        except ValueError:  # no parallel kernel has run yet: layer unknown, be safe
+            return _NUMBA_LOCK
+    return _NUMBA_LOCK if _NUMBA_SERIALIZE else contextlib.nullcontext()
+
+
+if _HAVE_NUMBA:
+    @njit(parallel=True, cache=True)
+    def _assemble_numba(canvas, tile_arr, mapping, cols, ts):
+        for k in prange(mapping.shape[0]):
+            r = k // cols
+            c = k % cols
+            canvas[r * ts:(r + 1) * ts, c * ts:(c + 1) * ts] = tile_arr[mapping[k]]
+
+    @njit(parallel=True, cache=True)
+    def _assemble_tinted_numba(canvas, tile_arr, mapping, cell_colors, cols, ts, s8):
+        keep = 256 - s8
+        for k in prange(mapping.shape[0]):
+            r = k // cols
+            c = k % cols
+            tile = tile_arr[mapping[k]]
+            for y in range(ts):
+                for x in range(ts):
+                    for ch in range(3):
+                        v = (np.int32(tile[y, x, ch]) * keep + np.int32(cell_colors[k, ch]) * s8) >> 8
+                        canvas[r * ts + y, c * ts + x, ch] = np.uint8(v)
+
+
+# One thread per output pixel: find its cell, copy (or tint) from that cell's tile
+_GPU_ASSEMBLE_SRC = r"""
+extern "C" __global__
+void assemble(const unsigned char* tiles, const long long* mapping, const unsigned char* cell_colors,
+              unsigned char* out, int rows, int cols, int ts, int tint, int s8)
+{
+    long long i = (long long)blockDim.x * blockIdx.x + threadIdx.x;
+    long long width = (long long)cols * ts;
+    if (i >= (long long)rows * ts * width) return;
+    long long y = i / width;
+    long long x = i % width;
+    long long cell = (y / ts) * cols + (x / ts);
+    const unsigned char* src = tiles + ((mapping[cell] * ts + y % ts) * ts + x % ts) * 3;
+    unsigned char* dst = out + i * 3;
+    for (int ch = 0; ch < 3; ++ch) {
+        if (tint) {
+            dst[ch] = (unsigned char)((src[ch] * (256 - s8) + cell_colors[cell * 3 + ch] * s8) >> 8);
+        } else {
+            dst[ch] = src[ch];
+        }
+    }
+}
+"""
+_GPU_KERNEL = cp.RawKernel(_GPU_ASSEMBLE_SRC, "assemble") if _HAVE_CUPY else None
+_GPU_FAILED = False  # set after the first failed GPU attempt; later calls stay on the CPU
+
+
+def _assemble_canvas_gpu(
+    tile_arr: np.ndarray,
+    mapping: np.ndarray,
+    rows: int,
+    cols: int,
+    tile_size: int,
+    cell_colors: np.ndarray | None,
+    s8: int,
+) -> np.ndarray:
+    """CuPy version of _assemble_canvas: upload tiles once, scatter on device, download."""
+    tiles_d = cp.asarray(tile_arr)
+    mapping_d = cp.asarray(mapping)
+    tint = cell_colors is not None
+    colors_d = cp.asarray(cell_colors) if tint else cp.zeros(3, dtype=cp.uint8)
+    out_d = cp.empty((rows * tile_size, cols * tile_size, 3), dtype=cp.uint8)
+    threads = 256
+    blocks = (out_d.shape[0] * out_d.shape[1] + threads - 1) // threads
+    _GPU_KERNEL(
+        (blocks,), (threads,),
+        (tiles_d, mapping_d, colors_d, out_d,
+         np.int32(rows), np.int32(cols), np.int32(tile_size), np.int32(tint), np.int32(s8)),
+    )
+    return cp.asnumpy(out_d)
+
+
+def _assemble_canvas(
+    tile_arr: np.ndarray,      # (U, ts, ts, 3) uint8
+    mapping: np.ndarray,       # (N,) index into tile_arr, row-major over cells
+    rows: int,
+    cols: int,
+    tile_size: int,
+    cell_colors: np.ndarray | None = None,  # (N, 3) 0-255 — tint targets (Style B)
+    strength: float = 0.55,
+    gpu: bool = False,
+) -> np.ndarray:
     """
-    Given a list of raw image bytes, return a palette list:
-    [{"index": i, "r": float, "g": float, "b": float}, ...]
+    Write each cell's tile into a (rows*ts, cols*ts, 3) uint8 canvas, optionally
+    tinting toward cell_colors. With gpu=True and CuPy installed the scatter runs
+    as a CUDA kernel; otherwise a parallel Numba kernel (one cell per iteration)
+    when numba is installed, else one strided numpy copy.
     """
-    palette = []
-    for i, data in enumerate(raw_images):
+    mapping = np.ascontiguousarray(mapping, dtype=np.int64)
+    if cell_colors is not None:
+        # Tint targets at uint8 precision for the fixed-point blend
+        cell_colors = np.clip(np.rint(cell_colors), 0, 255).astype(np.uint8)
+    s8 = _tint_weight(strength)
+    global _GPU_FAILED
+    if gpu and _HAVE_CUPY and not _GPU_FAILED:
         try:
-            img = Image.open(io.BytesIO(data))
-            r, g, b = _avg_color(img)
-            palette.append({"index": i, "r": r, "g": g, "b": b})
+            return _assemble_canvas_gpu(tile_arr, mapping, rows, cols, tile_size, cell_colors, s8)
         except Exception:
-            continue
-    return palette
+            # No usable CUDA device/driver: say so once, then use the CPU paths below
+            _GPU_FAILED = True
+            logger.warning("GPU canvas assembly failed; falling back to the CPU", exc_info=True)
+
+    canvas = np.empty((rows * tile_size, cols * tile_size, 3), dtype=np.uint8)
+    if _HAVE_NUMBA:
+        if cell_colors is None:
+            with _numba_guard():
+                _assemble_numba(canvas, tile_arr, mapping, cols, tile_size)
+        else:
+            with _numba_guard():
+                _assemble_tinted_numba(canvas, tile_arr, mapping, cell_colors, cols, tile_size, s8)
+        return canvas
+
+    # View the canvas as (rows, ts, cols, ts, 3) so every tile lands in one strided copy
+    cells_view = canvas.reshape(rows, tile_size, cols, tile_size, 3)
+    tiles_grid = tile_arr[mapping].reshape(rows, cols, tile_size, tile_size, 3)
+    cells_view[...] = tiles_grid.transpose(0, 2, 1, 3, 4)
+    if cell_colors is not None:
+        targets = cell_colors.reshape(rows, cols, 3)[:, None, :, None, :]
+        cells_view[...] = _tint(cells_view, targets, strength)
+    return canvas
+
+
+def warm_up() -> str | None:
+    """
+    Compile (or load from the on-disk cache) the Numba kernels ahead of the first request.
+    Returns the Numba threading layer in use (None without Numba); under "workqueue"
+    kernel calls are serialized by _numba_guard.
+    """
+    if not _HAVE_NUMBA:
+        return None
+    tiles = np.zeros((1, 1, 1, 3), dtype=np.uint8)
+    mapping = np.zeros(1, dtype=np.int64)
+    _assemble_canvas(tiles, mapping, 1, 1, 1)
+    _assemble_canvas(tiles, mapping, 1, 1, 1, cell_colors=np.zeros((1, 3), dtype=np.float32))
+    _nearest_positions(np.zeros((1, 3), dtype=np.float32), np.zeros((1, 3), dtype=np.float32))
+    _numba_guard()  # the layer is chosen now: settle whether calls must be serialized
+    return numba.threading_layer()
+
+
+# ---------------------------------------------------------------------------
+# Resized tile cache
+# ---------------------------------------------------------------------------
+
+class TileCache:
+    """
+    Thread-safe LRU cache of resized (ts, ts, 3) uint8 tiles, bounded by total bytes.
+    Key tiles by (content hash, tile_size) so sessions uploading the same
+    photos share entries. Supports the get / item-assignment subset of dict
+    that generate_mosaic uses, so a plain dict works in its place.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._data: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: np.ndarray | None = None) -> np.ndarray | None:
+        with self._lock:
+            tile = self._data.get(key)
+            if tile is None:
+                return default
+            self._data.move_to_end(key)
+            return tile
+
+    def __setitem__(self, key: Hashable, tile: np.ndarray) -> None:
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._data[key] = tile
+            self._bytes += tile.nbytes
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# ---------------------------------------------------------------------------
+# Output encoding
+# ---------------------------------------------------------------------------
+
+# Supported output formats → (MIME type, file extension)
+OUTPUT_FORMATS = {
+    "PNG": ("image/png", "png"),
+    "WEBP": ("image/webp", "webp"),
+    "JPEG": ("image/jpeg", "jpg"),
+}
+JPEG_QUALITY = 90
+
+
+def _check_output_format(output_format: str) -> str:
+    """Normalize an output format name to its OUTPUT_FORMATS key."""
+    key = output_format.upper()
+    if key not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format!r}")
+    return key
+
+
+def resolve_output_format(output_format: str | None, a4_output: bool = False) -> str:
+    """
+    The OUTPUT_FORMATS key to encode with: output_format normalized, or when None,
+    JPEG for A4 output (a 300 DPI PNG is ~25 MB and slow to deflate) and PNG otherwise.
+    Raises ValueError for unknown formats.
+    """
+    if output_format is None:
+        return "JPEG" if a4_output else "PNG"
+    return _check_output_format(output_format)
+
+
+def _encode(
+    canvas: np.ndarray,
+    output_format: str = "PNG",
+    compress_level: int = 1,
+    backend: ImageBackend = "pil",
+) -> bytes:
+    """
+    Encode the finished (H, W, 3) uint8 mosaic.
+    PNG skips optimize=True (a second Huffman pass) and defaults to zlib level 1;
+    WebP is lossless with the fastest method, usually much quicker than PNG on photos;
+    JPEG (quality 90, 4:2:0) skips zlib entirely and is the fastest of the three.
+    """
+    output_format = _check_output_format(output_format)
+    if backend == "vips":
+        h, w, _ = canvas.shape
+        vimg = pyvips.Image.new_from_memory(np.ascontiguousarray(canvas).data, w, h, 3, "uchar")
+        if output_format == "JPEG":
+            return vimg.write_to_buffer(".jpg", Q=JPEG_QUALITY, subsample_mode="on")
+        if output_format == "WEBP":
+            return vimg.write_to_buffer(".webp", lossless=True, effort=0)
+        return vimg.write_to_buffer(".png", compression=compress_level)
+
+    img = Image.fromarray(canvas, "RGB")
+    buf = io.BytesIO()
+    if output_format == "JPEG":
+        img.save(buf, format="JPEG", quality=JPEG_QUALITY, subsampling=2)
+    elif output_format == "WEBP":
+        img.save(buf, format="WEBP", lossless=True, method=0)
+    else:
+        img.save(buf, format="PNG", optimize=False, compress_level=compress_level)
+    return buf.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Public API
+# ---------------------------------------------------------------------------
+
+# Palette as structure-of-arrays: {"indices": (P,) int64 source index, "rgb": (P, 3) float32 mean color}
+Palette = Dict[str, np.ndarray]
+
+
+def as_palette(palette: Palette | List[dict]) -> Palette:
+    """Return palette as a Palette, converting a legacy list of {"index", "r", "g", "b"} dicts."""
+    if isinstance(palette, dict):
+        return palette
+    indices = np.fromiter((p["index"] for p in palette), dtype=np.int64, count=len(palette))
+    rgb = np.array([[p["r"], p["g"], p["b"]] for p in palette], dtype=np.float32).reshape(-1, 3)
+    return {"indices": indices, "rgb": rgb}
+
+
+def palette_entries(palette: Palette) -> List[dict]:
+    """The palette as a list of {"index", "r", "g", "b"} dicts — its JSON form for the frontend."""
+    return [
+        {"index": i, "r": r, "g": g, "b": b}
+        for i, (r, g, b) in zip(palette["indices"].tolist(), palette["rgb"].tolist())
+    ]
+
+
+def palette_lab_arrays(palette: Palette | List[dict]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert a palette (output of analyze_sources) to LAB once.
+    Returns (palette_lab, palette_sq): a contiguous (P, 3) float32 LAB array and
+    its (P,) squared norms, both in palette order. Callers cache these per
+    session and pass them to generate_mosaic / generate_preview.
+    """
+    palette_lab = np.ascontiguousarray(rgb_to_lab(as_palette(palette)["rgb"]))
+    palette_sq = np.einsum("ij,ij->i", palette_lab, palette_lab)
+    return palette_lab, palette_sq
+
+
+def _analyze_one(item: Tuple[int, bytes], backend: ImageBackend = "pil") -> dict | None:
+    """Decode one source image and return its palette entry, or None if undecodable."""
+    i, data = item
+    try:
+        if backend == "vips":
+            # Shrink-on-load thumbnail; only the mean color is needed
+            arr = _vips_to_array(pyvips.Image.thumbnail_buffer(data, 64))
+            r, g, b = (float(v) for v in arr.reshape(-1, 3).mean(axis=0))
+            return {"index": i, "r": r, "g": g, "b": b}
+        img = Image.open(io.BytesIO(data))
+        if img.format == "JPEG":
+            # Only the mean color is needed: let libjpeg DCT-downscale on decode
+            img.draft("RGB", (64, 64))
+        r, g, b = _avg_color(img)
+    except Exception:
+        return None
+    return {"index": i, "r": r, "g": g, "b": b}
+
+
+def analyze_sources(raw_images: List[bytes], backend: ImageBackend = "pil") -> Palette:
+    """
+    Given a list of raw image bytes, return a Palette:
+    {"indices": (P,) int64 position in raw_images, "rgb": (P, 3) float32 mean color}
+    Images are decoded on a thread pool (Pillow and libvips release the GIL while
+    decoding); order follows raw_images and undecodable images are skipped.
+    """
+    _check_backend(backend)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        results = list(ex.map(partial(_analyze_one, backend=backend), enumerate(raw_images)))
+    return as_palette([entry for entry in results if entry is not None])
 
 
 def generate_mosaic(
     main_image_bytes: bytes,
-    source_images_bytes: List[bytes],
-    palette: List[dict],
+    source_images: Sequence[bytes | str | os.PathLike],
+    palette: Palette | List[dict],
     tile_size: int = 40,
     style: str = "A",           # "A" | "B" | "C"
     allow_repeats: bool = True,
     overlay_opacity: float = 0.25,
     shuffle_sources: bool = False,
     a4_output: bool = False,
-    tile_cache: dict | None = None,  # session-level cache: {(idx, tile_size): Image}
+    tile_cache: dict | TileCache | None = None,  # {(source key, tile_size): uint8 ndarray}
+    palette_lab: np.ndarray | None = None,  # (P, 3) from palette_lab_arrays()
+    palette_sq: np.ndarray | None = None,   # (P,) from palette_lab_arrays()
+    palette_lut: np.ndarray | None = None,  # (bins³, k) from build_lab_lut()
+    output_format: str | None = None,  # key of OUTPUT_FORMATS; None → JPEG for A4, else PNG
+    compress_level: int = 1,     # PNG zlib level 0-9 (1 = fast)
+    gpu: bool = False,
+    backend: ImageBackend = "pil",
+    source_keys: Sequence[Hashable] | None = None,
 ) -> bytes:
     """
-    Generate a mosaic PNG and return raw bytes.
+    Generate a mosaic image and return the encoded bytes.
 
     Parameters
     ----------
     main_image_bytes   : JPEG/PNG bytes of the main target image
-    source_images_bytes: raw bytes for each sub-image in palette order
-    palette            : output of analyze_sources()
+    source_images      : raw bytes or file path for each sub-image, indexed by palette "index"
+    palette            : output of analyze_sources() (or a legacy list of entry dicts)
     tile_size          : size of each mosaic cell in pixels (5-200)
     style              : blending style A/B/C
     allow_repeats      : whether the same sub-image may be reused
     overlay_opacity    : opacity of the main image ghost (Style C only)
     shuffle_sources    : randomly shuffle the palette before matching (for variety)
     a4_output          : resize main image to A4 @ 300 DPI before tiling
-    tile_cache         : optional dict for caching resized tiles across calls
+    tile_cache         : optional dict / TileCache of resized (ts, ts, 3) uint8 tiles across calls
+    source_keys        : optional content keys per source (same indexing as source_images)
+                         used as cache keys instead of the index, so caches can be shared
+    palette_lab        : optional precomputed LAB palette (see palette_lab_arrays)
+    palette_sq         : optional precomputed squared norms of palette_lab
+    palette_lut        : optional LAB→palette lookup table for allow_repeats matching
+    output_format      : "PNG", "WEBP" (lossless) or "JPEG"; None picks one via
+                         resolve_output_format (JPEG for A4 output, PNG otherwise)
+    compress_level     : PNG compression level; 1 is fast, 6-9 trade time for size
+    gpu                : assemble the canvas on a CUDA GPU via CuPy (ignored if unavailable)
+    backend            : "pil" or "vips" — library for source tile decode/resize and encoding
     """
-    if not palette or not source_images_bytes:
+    palette = as_palette(palette)
+    if not len(palette["indices"]) or not source_images:
         raise ValueError("No source images / palette provided")
+    _check_backend(backend)
+    output_format = resolve_output_format(output_format, a4_output)
 
     if tile_cache is None:
         tile_cache = {}
@@ -185,159 +851,128 @@ def generate_mosaic(
             target_w, target_h = A4_H, A4_W
         else:                  # portrait
             target_w, target_h = A4_W, A4_H
-        # Scale to cover target, then center-crop
+        # Scale to cover target, center-cropped: ImageOps.fit crops in source
+        # coordinates during the resize, so no oversized intermediate is built
         scale = max(target_w / main_w, target_h / main_h)
-        new_w = int(main_w * scale)
-        new_h = int(main_h * scale)
-        main = main.resize((new_w, new_h), Image.LANCZOS)
-        left = (new_w - target_w) // 2
-        top  = (new_h - target_h) // 2
-        main = main.crop((left, top, left + target_w, top + target_h))
+        # BILINEAR is plenty for a photo backdrop; keep LANCZOS for large upscales
+        main = ImageOps.fit(
+            main,
+            (target_w, target_h),
+            method=Image.LANCZOS if scale > 2 else Image.BILINEAR,
+            centering=(0.5, 0.5),
+        )
         main_w, main_h = main.size
 
     cols = math.ceil(main_w / tile_size)
     rows = math.ceil(main_h / tile_size)
     canvas_w = cols * tile_size
     canvas_h = rows * tile_size
-    main_scaled = main.resize((canvas_w, canvas_h), Image.LANCZOS)
 
     # ---- Build palette arrays -------------------------------------------
-    palette_colors = np.array([[p["r"], p["g"], p["b"]] for p in palette], dtype=np.float32)
-    palette_indices = [p["index"] for p in palette]
+    if palette_lab is None or palette_sq is None:
+        palette_lab, palette_sq = palette_lab_arrays(palette)
+    palette_indices = palette["indices"]
 
     if shuffle_sources:
-        combined = list(zip(palette_colors.tolist(), palette_indices))
-        random.shuffle(combined)
-        palette_colors = np.array([c[0] for c in combined], dtype=np.float32)
-        palette_indices = [c[1] for c in combined]
+        perm = np.random.default_rng().permutation(len(palette_indices))
+        palette_lab = palette_lab[perm]
+        palette_sq = palette_sq[perm]
+        palette_indices = palette_indices[perm]
+        palette_lut = None  # table positions refer to the unshuffled palette
 
     # ---- Vectorized cell average computation ----------------------------
-    # Convert entire scaled image to array once, then reshape to extract tile means
-    main_arr = np.array(main_scaled, dtype=np.float32)  # (canvas_h, canvas_w, 3)
-    # Reshape to (rows, tile_size, cols, tile_size, 3) then mean over tile dims
-    cell_colors = (
-        main_arr
-        .reshape(rows, tile_size, cols, tile_size, 3)
-        .mean(axis=(1, 3))
-    )  # (rows, cols, 3)
+    cell_colors = _cell_means(main, cols, rows)  # (rows, cols, 3)
     cell_colors_flat = cell_colors.reshape(rows * cols, 3)  # (N, 3)
 
     # ---- Vectorized nearest-neighbor matching ---------------------------
     if allow_repeats:
-        best_positions = _match_all_cells(cell_colors_flat, palette_colors)  # (N,)
+        best_positions = _match_all_cells(cell_colors_flat, palette_lab, palette_sq, palette_lut)  # (N,)
     else:
-        # For unique mode we still need per-cell logic, but vectorize the distance matrix
-        cell_lab = rgb_to_lab(cell_colors_flat)       # (N, 3)
-        palette_lab = rgb_to_lab(palette_colors)       # (P, 3)
-        diff = palette_lab[:, None, :] - cell_lab[None, :, :]
-        dists = (diff ** 2).sum(axis=2)  # (P, N)
-        # For each cell, get sorted palette positions by distance
-        sorted_positions = np.argsort(dists, axis=0)  # (P, N) — sorted by dist per cell
-
-        available = set(range(len(palette_indices)))
-        best_positions = np.zeros(rows * cols, dtype=np.int32)
-        for cell_idx in range(rows * cols):
-            chosen = None
-            for pos in sorted_positions[:, cell_idx]:
-                p = int(pos)
-                if p in available:
-                    chosen = p
-                    available.discard(p)
-                    break
-            if chosen is None:
-                chosen = int(sorted_positions[0, cell_idx])  # fallback
-            best_positions[cell_idx] = chosen
+        best_positions = _match_unique(cell_colors_flat, palette_lab, palette_sq)  # (N,)
 
     # ---- Cached source tile loader --------------------------------------
-    def get_source(idx: int) -> Image.Image:
-        key = (idx, tile_size)
-        if key not in tile_cache:
+    def get_source(idx: int) -> np.ndarray:
+        key = (source_keys[idx] if source_keys is not None else idx, tile_size)
+        tile = tile_cache.get(key)
+        if tile is None:
             try:
-                img = Image.open(io.BytesIO(source_images_bytes[idx])).convert("RGB")
-                tile_cache[key] = img.resize((tile_size, tile_size), Image.LANCZOS)
+                tile = _load_tile(source_images[idx], tile_size, backend)
             except Exception:
-                tile_cache[key] = Image.new("RGB", (tile_size, tile_size), (128, 128, 128))
-        return tile_cache[key]
-
-    # ---- Create output canvas -------------------------------------------
-    mosaic = Image.new("RGB", (canvas_w, canvas_h))
-
-    for row in range(rows):
-        for col in range(cols):
-            cell_idx = row * cols + col
-            best_pos = int(best_positions[cell_idx])
-            src_idx = palette_indices[best_pos]
-            tile = get_source(src_idx).copy()
-
-            if style == "B":
-                cell_r, cell_g, cell_b = (
-                    float(cell_colors[row, col, 0]),
-                    float(cell_colors[row, col, 1]),
-                    float(cell_colors[row, col, 2]),
-                )
-                tile = _tint(tile, (cell_r, cell_g, cell_b))
-
-            mosaic.paste(tile, (col * tile_size, row * tile_size))
-
-    # Style C: ghost overlay of original image
+                # Grey placeholder for this call only: the failure may be transient
+                # (file removed mid-request, EMFILE), and a shared cache keyed by
+                # content would hand the placeholder to every session with this photo
+                return np.full((tile_size, tile_size, 3), 128, dtype=np.uint8)
+            tile_cache[key] = tile
+        return tile
+
+    # ---- Stack the tiles actually used ----------------------------------
+    cell_src = palette_indices[best_positions]  # (N,)
+    used_src, mapping = np.unique(cell_src, return_inverse=True)
+    # Decode/resize cache misses on a thread pool — Pillow and libvips release the GIL
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        tile_arr = np.stack(list(ex.map(get_source, used_src.tolist())))  # (U, ts, ts, 3) uint8
+
+    # ---- Assemble output canvas -----------------------------------------
+    canvas = _assemble_canvas(
+        tile_arr,
+        mapping.reshape(-1),
+        rows,
+        cols,
+        tile_size,
+        cell_colors=cell_colors_flat if style == "B" else None,
+        gpu=gpu,
+    )
+
+    # Style C: ghost overlay of original image, blended in uint16 fixed point
     if style == "C":
-        ghost = main_scaled.convert("RGBA")
-        alpha = int(overlay_opacity * 255)
-        r_ch, g_ch, b_ch, _ = ghost.split()
-        a_ch = Image.new("L", ghost.size, alpha)
-        ghost = Image.merge("RGBA", (r_ch, g_ch, b_ch, a_ch))
-        mosaic = mosaic.convert("RGBA")
-        mosaic.paste(ghost, (0, 0), ghost)
-        mosaic = mosaic.convert("RGB")
+        alpha = int(overlay_opacity * 256)
+        main_scaled = main.resize((canvas_w, canvas_h), Image.BILINEAR)
+        ghost = np.asarray(main_scaled, dtype=np.uint8)
+        canvas = (
+            (canvas.astype(np.uint16) * (256 - alpha) + ghost.astype(np.uint16) * alpha) >> 8
+        ).astype(np.uint8)
 
-    buf = io.BytesIO()
-    mosaic.save(buf, format="PNG", optimize=True, compress_level=6)
-    buf.seek(0)
-    return buf.read()
+    return _encode(canvas, output_format, compress_level, backend)
 
 
 def generate_preview(
     main_image_bytes: bytes,
-    palette: List[dict],
+    palette: Palette | List[dict],
     tile_size: int = 40,
+    palette_lab: np.ndarray | None = None,
+    palette_sq: np.ndarray | None = None,
+    palette_lut: np.ndarray | None = None,
 ) -> dict:
     """
-    Generate a low-res preview as a list of colored blocks.
-    Returns: {"cols": N, "rows": M, "blocks": [{x, y, cellR, cellG, cellB, srcR, srcG, srcB}]}
-    Uses vectorized cell averaging and LAB-space matching.
+    Generate a low-res preview as flat per-cell color arrays.
+    Returns: {"cols": N, "rows": M, "cellRGB": str, "srcRGB": str} where each string is
+    base64 of rows*cols*3 uint8 bytes in row-major cell order (R, G, B per cell).
+    Uses vectorized cell averaging and LAB-space matching; pass the session's
+    palette_lab / palette_sq (see palette_lab_arrays) to skip re-converting the palette,
+    and palette_lut (see build_lab_lut) to match by table lookup.
     """
+    palette = as_palette(palette)
     main = Image.open(io.BytesIO(main_image_bytes)).convert("RGB")
     main_w, main_h = main.size
 
     cols = math.ceil(main_w / tile_size)
     rows = math.ceil(main_h / tile_size)
-    canvas_w = cols * tile_size
-    canvas_h = rows * tile_size
-    main_scaled = main.resize((canvas_w, canvas_h), Image.LANCZOS)
 
-    palette_colors = np.array([[p["r"], p["g"], p["b"]] for p in palette], dtype=np.float32)
+    if palette_lab is None or palette_sq is None:
+        palette_lab, palette_sq = palette_lab_arrays(palette)
 
     # Vectorized cell averages
-    main_arr = np.array(main_scaled, dtype=np.float32)
-    cell_colors = (
-        main_arr
-        .reshape(rows, tile_size, cols, tile_size, 3)
-        .mean(axis=(1, 3))
-    )  # (rows, cols, 3)
+    cell_colors = _cell_means(main, cols, rows)  # (rows, cols, 3)
     cell_colors_flat = cell_colors.reshape(rows * cols, 3)
 
     # Vectorized LAB matching
-    best_positions = _match_all_cells(cell_colors_flat, palette_colors)  # (N,)
-
-    blocks = []
-    for row in range(rows):
-        for col in range(cols):
-            cell_idx = row * cols + col
-            best = palette[int(best_positions[cell_idx])]
-            cr, cg, cb = cell_colors[row, col]
-            blocks.append({
-                "x": col, "y": row,
-                "cellR": int(cr), "cellG": int(cg), "cellB": int(cb),
-                "srcR": int(best["r"]), "srcG": int(best["g"]), "srcB": int(best["b"]),
-            })
-    return {"cols": cols, "rows": rows, "blocks": blocks}
+    best_positions = _match_all_cells(cell_colors_flat, palette_lab, palette_sq, palette_lut)  # (N,)
+
+    cell_u8 = cell_colors_flat.astype(np.uint8)                # (N, 3)
+    src_u8 = palette["rgb"][best_positions].astype(np.uint8)   # (N, 3)
+    return {
+        "cols": cols,
+        "rows": rows,
+        "cellRGB": base64.b64encode(cell_u8.tobytes()).decode("ascii"),
+        "srcRGB": base64.b64encode(src_u8.tobytes()).decode("ascii"),
+    }
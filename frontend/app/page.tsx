@@ -156,11 +156,14 @@ export default function HomePage() {
     }
   }, [mainImageFile, palette, sessionId, tileSize, setIsPreviewLoading, setPreviewData]);
 
+  // The backend picks the format (JPEG for A4, PNG otherwise) — follow the blob type
+  const resultExt = resultBlob?.type === "image/jpeg" ? "jpg" : resultBlob?.type === "image/webp" ? "webp" : "png";
+
   const handleDownload = () => {
     if (!resultBlob) return;
     const a = document.createElement("a");
     a.href = URL.createObjectURL(resultBlob);
-    a.download = `mosaic-${style}-${tileSize}px.png`;
+    a.download = `mosaic-${style}-${tileSize}px.${resultExt}`;
     a.click();
   };
 
@@ -370,7 +373,7 @@ export default function HomePage() {
                     <path strokeLinecap="round" strokeLinejoin="round" strokeWidth={2.5}
                       d="M4 16v1a3 3 0 003 3h10a3 3 0 003-3v-1m-4-4l-4 4m0 0l-4-4m4 4V4" />
                   </svg>
-                  Download PNG
+                  Download {resultExt === "jpg" ? "JPEG" : resultExt.toUpperCase()}
                 </button>
               </div>
               <ZoomLoupe src={resultUrl} magnification={4} loupeSize={180} />
@@ -19,10 +19,13 @@ export default function MosaicPreviewCanvas({ data }: Props) {
         canvas.width = data.cols * BLOCK;
         canvas.height = data.rows * BLOCK;
 
-        data.blocks.forEach(({ x, y, srcR, srcG, srcB }) => {
-            ctx.fillStyle = `rgb(${srcR},${srcG},${srcB})`;
+        const src = Uint8Array.from(atob(data.srcRGB), (c) => c.charCodeAt(0));
+        for (let i = 0; i < data.cols * data.rows; i++) {
+            const x = i % data.cols;
+            const y = Math.floor(i / data.cols);
+            ctx.fillStyle = `rgb(${src[i * 3]},${src[i * 3 + 1]},${src[i * 3 + 2]})`;
             ctx.fillRect(x * BLOCK, y * BLOCK, BLOCK, BLOCK);
-        });
+        }
     }, [data]);
 
     return (
@@ -10,21 +10,12 @@ export interface PaletteEntry {
     b: number;
 }
 
-export interface PreviewBlock {
-    x: number;
-    y: number;
-    cellR: number;
-    cellG: number;
-    cellB: number;
-    srcR: number;
-    srcG: number;
-    srcB: number;
-}
-
 export interface PreviewData {
     cols: number;
     rows: number;
-    blocks: PreviewBlock[];
+    // base64 of rows*cols*3 uint8 values, row-major, read by stride 3
+    cellRGB: string;
+    srcRGB: string;
 }
 
 interface MosaicState {